@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import pytest
+
+from tpkutils.mbtiles import MBtiles
+from pymbtiles import Tile
+
+
+def test_invalid_mode(tmpdir):
+    with pytest.raises(ValueError):
+        MBtiles(str(tmpdir.join("test.mbtiles")), mode="a")
+
+
+def test_missing_file(tmpdir):
+    with pytest.raises(IOError):
+        MBtiles(str(tmpdir.join("missing.mbtiles")), mode="r")
+
+
+def test_add_tile(tmpdir):
+    filename = str(tmpdir.join("test.mbtiles"))
+
+    with MBtiles(filename, "w") as mbtiles:
+        mbtiles.add_tile(0, 0, 0, b"123")
+
+    assert os.path.exists(filename)
+
+    with sqlite3.connect(filename) as db:
+        cursor = db.cursor()
+        cursor.execute(
+            "select tile_data from tiles "
+            "where zoom_level=0 and tile_column=0 and tile_row=0"
+        )
+        row = cursor.fetchone()
+        assert row
+        assert row[0] == b"123"
+        cursor.close()
+
+
+def test_add_tiles(tmpdir):
+    filename = str(tmpdir.join("test.mbtiles"))
+
+    tiles = [Tile(1, x, y, b"123") for x in (0, 1) for y in (0, 1)]
+
+    with MBtiles(filename, "w") as mbtiles:
+        mbtiles.add_tiles(tiles)
+
+        assert mbtiles.zoom_range() == (1, 1)
+        assert mbtiles.row_range(1) == (0, 1)
+        assert mbtiles.col_range(1) == (0, 1)
+        assert mbtiles.read_tile(1, 0, 0) == b"123"
+        assert mbtiles.read_tile(2, 0, 0) is None
+
+    with sqlite3.connect(filename) as db:
+        cursor = db.cursor()
+        cursor.execute("select count(*) from tiles")
+        assert cursor.fetchone()[0] == 4
+
+        # identical tile data must be stored only once
+        cursor.execute("select count(*) from images")
+        assert cursor.fetchone()[0] == 1
+        cursor.close()
+
+
+def test_metadata(tmpdir):
+    filename = str(tmpdir.join("test.mbtiles"))
+
+    with MBtiles(filename, "w") as mbtiles:
+        mbtiles.meta["name"] = "test"
+        mbtiles.meta.update({"version": "1.0.0"})
+
+    with MBtiles(filename, "r") as mbtiles:
+        assert mbtiles.meta["name"] == "test"
+        assert mbtiles.meta["version"] == "1.0.0"
@@ -1,4 +1,5 @@
 import os
+import shutil
 import sqlite3
 import pytest
 import hashlib
@@ -35,6 +36,21 @@ def test_metadata():
         assert tpk.zoom_levels == [0, 1, 2, 3, 4]
 
 
+def test_metadata_cache(tmpdir):
+    filename = str(tmpdir.join("states_filled.tpk"))
+    shutil.copyfile("tests/data/states_filled.tpk", filename)
+
+    with TPK(filename, cache_metadata=True) as tpk:
+        expected = {field: getattr(tpk, field) for field in TPK.METADATA_FIELDS}
+
+    assert os.path.exists("{0}.tpkmeta.json".format(filename))
+
+    # second open must read from the cache and yield identical metadata
+    with TPK(filename, cache_metadata=True) as tpk:
+        for field, value in expected.items():
+            assert getattr(tpk, field) == value
+
+
 def test_read_tile():
     with TPK("tests/data/states_filled.tpk") as tpk:
         tile = next(tpk.read_tiles(zoom=[2]))
@@ -48,6 +64,16 @@ def test_read_tile():
         assert tile2 == tile
 
 
+def test_close_with_open_tile_generator():
+    tpk = TPK("tests/data/states_filled.tpk")
+    tiles = tpk.read_tiles(zoom=[2])
+    next(tiles)
+
+    # must not raise even though the generator still holds views over the
+    # memory-mapped archive
+    tpk.close()
+
+
 def test_export_mbtiles(tmpdir):
     with TPK("tests/data/states_filled.tpk") as tpk:
         mbtiles_filename = str(tmpdir.join("test.mbtiles"))
@@ -103,6 +129,25 @@ def test_export_mbtiles_int_zoom(tmpdir):
     assert os.path.exists(mbtiles_filename)
 
 
+def test_export_mbtiles_append(tmpdir):
+    mbtiles_filename = str(tmpdir.join("test.mbtiles"))
+
+    with TPK("tests/data/states_filled.tpk") as tpk:
+        tpk.to_mbtiles(mbtiles_filename, zoom=0)
+        tpk.to_mbtiles(mbtiles_filename, zoom=[1, 2], append=True)
+
+    with MBtiles(mbtiles_filename) as mbtiles:
+        assert mbtiles.zoom_range() == (0, 2)
+        assert mbtiles.meta["minzoom"] == "0"
+        assert mbtiles.meta["maxzoom"] == "2"
+
+
+def test_export_mbtiles_append_missing_file(tmpdir):
+    with TPK("tests/data/states_filled.tpk") as tpk:
+        with pytest.raises(IOError):
+            tpk.to_mbtiles(str(tmpdir.join("missing.mbtiles")), append=True)
+
+
 def test_export_mbtiles_mixed_format(tmpdir):
     tpk = TPK("tests/data/states_filled.tpk")
     tpk.format = "mixed"  # this is a hack to make test fail, need a test file for this
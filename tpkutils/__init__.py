@@ -12,18 +12,30 @@ from math import log2
 
 import json
 import logging
-import math
+import mmap
+import re
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from queue import Queue, Full
+from struct import unpack, Struct
 from xml.etree import ElementTree
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 
 import hashlib
 import os
-from io import BytesIO
 
-from pymbtiles import MBtiles, Tile
+from pymbtiles import Tile
 import mercantile
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from tpkutils.mbtiles import MBtiles, BATCH_SIZE
+
 
 logger = logging.getLogger("tpkutils")
 
@@ -45,6 +57,12 @@ EMPTY_TILES = {
     "147ca8bf480d89b17921e24e3c09edcf1cb2228b",  # completely transparent PNG
 }
 
+# the same hashes as raw digest bytes: comparing digest() output directly
+# skips the hex encoding of every hash computed during drop-empty checks
+_EMPTY_TILE_DIGESTS = frozenset(bytes.fromhex(h) for h in EMPTY_TILES)
+
+_sha1 = hashlib.sha1
+
 
 def buffer_to_offset(buffer):
     """
@@ -66,7 +84,93 @@ def buffer_to_offset(buffer):
     int: offset
     """
 
-    return sum(((v & 0xFF) * 2 ** (i * 8) for i, v in enumerate(buffer)))
+    return int.from_bytes(buffer, "little")
+
+
+# byte weights of the 5-byte little-endian bundlx records, for the numpy
+# vectorized index decode
+if numpy is not None:
+    _INDEX_WEIGHTS = 256 ** numpy.arange(INDEX_SIZE, dtype=numpy.int64)
+    _LENGTH_WEIGHTS = 256 ** numpy.arange(4, dtype=numpy.int64)
+
+
+def occupied_tile_offsets(offsets, bundle_data):
+    """
+    Return (index, offset) pairs for tile positions that have data in the
+    bundle, skipping empty slots.
+
+    With numpy, the 4-byte length prefix at every offset is gathered in one
+    vectorized pass, so only occupied positions are visited by the caller;
+    otherwise every position is returned and the caller's read finds the
+    empty ones.
+
+    Parameters
+    ----------
+    offsets: sequence of int
+        tile offsets decoded from the bundlx index
+    bundle_data: bytes or memoryview
+        raw bundle bytes
+
+    Returns
+    -------
+    list of (index, offset) pairs
+    """
+
+    if numpy is None:
+        return list(enumerate(offsets))
+
+    buf = numpy.frombuffer(bundle_data, dtype=numpy.uint8)
+
+    # guard against offsets pointing outside the bundle
+    valid = offsets <= buf.size - 4
+    safe_offsets = numpy.where(valid, offsets, 0)
+    lengths = buf[safe_offsets[:, None] + numpy.arange(4)].dot(_LENGTH_WEIGHTS)
+    lengths[~valid] = 0
+
+    occupied = numpy.nonzero(lengths)[0]
+    return list(zip(occupied.tolist(), offsets[occupied].tolist()))
+
+
+# each 5-byte bundlx record split as uint32 low bytes + uint8 high byte,
+# for the struct-based index decode
+_INDEX_RECORD = Struct("<IB")
+
+# 4-byte little-endian tile length prefix within a bundle
+_TILE_LENGTH = Struct("<I")
+
+
+def parse_bundle_index(index_bytes):
+    """
+    Decode all tile offsets from the bundlx index in one pass.
+
+    The index is a packed array of 5-byte little-endian offsets, one per
+    tile position in the bundle.  When numpy is available, the whole index
+    is decoded with a single reshape + dot product; otherwise records are
+    unpacked with struct.iter_unpack as (low uint32, high uint8) pairs.
+
+    Parameters
+    ----------
+    index_bytes: bytes or memoryview
+        raw index bytes (16 byte header already stripped)
+
+    Returns
+    -------
+    list[int] or numpy.ndarray[int64]: offset of each tile in the bundle,
+    in index order
+    """
+
+    if numpy is not None:
+        values = numpy.frombuffer(
+            index_bytes, dtype=numpy.uint8, count=BUNDLE_DIM**2 * INDEX_SIZE
+        )
+        return values.reshape(-1, INDEX_SIZE).dot(_INDEX_WEIGHTS)
+
+    return [
+        low | (high << 32)
+        for low, high in _INDEX_RECORD.iter_unpack(
+            index_bytes[: BUNDLE_DIM**2 * INDEX_SIZE]
+        )
+    ]
 
 
 def calculate_zoom_from_resolution(resolution, tile_size=TILE_PIXEL_SIZE):
@@ -92,13 +196,116 @@ def calculate_zoom_from_resolution(resolution, tile_size=TILE_PIXEL_SIZE):
     return int(round(log2(WORLD_CIRCUMFERENCE / (resolution * tile_size))))
 
 
-def read_tile(bundle, offset):
+# blank tile blobs identified so far; lets repeated blank tiles be detected
+# by equality instead of re-hashing each one (bounded by len(EMPTY_TILES)),
+# plus their cheap (length, 16 byte prefix) signatures used as a prefilter
+_EMPTY_TILE_DATA = set()
+_EMPTY_TILE_SIGNATURES = set()
+
+
+def is_empty_tile(data):
+    """
+    Return True if tile data is a known empty tile (pure white, black,
+    or transparent).
+
+    Empty tiles recur thousands of times in a typical tile package and are
+    byte-identical, so once a blob has been identified as empty by its sha1
+    hash, subsequent copies are matched by equality without hashing.  A
+    (length, prefix) signature prefilter keeps non-empty tiles from paying
+    a full-content comparison before the sha1 check.
+
+    NOTE: sha1 itself cannot be swapped for a faster hash here: the known
+    empty tiles exist only as the sha1 constants in EMPTY_TILES.
+
+    Parameters
+    ----------
+    data: bytes
+        tile data bytes
+
+    Returns
+    -------
+    bool
+    """
+
+    signature = (len(data), bytes(data[:16]))
+    if signature in _EMPTY_TILE_SIGNATURES and data in _EMPTY_TILE_DATA:
+        return True
+
+    if _sha1(data).digest() in _EMPTY_TILE_DIGESTS:
+        _EMPTY_TILE_DATA.add(bytes(data))
+        _EMPTY_TILE_SIGNATURES.add(signature)
+        return True
+
+    return False
+
+
+def compile_path_format(path_format, ext):
+    """
+    Specialize a tile path format string into a (z, x, y) -> path function.
+
+    Simple formats (plain {z}/{x}/{y}/{ext} placeholders, the common case)
+    are converted to a %-template, which formats substantially faster than
+    str.format in the per-tile loop.  Anything fancier (format specs, extra
+    placeholders) falls back to str.format.
+
+    Parameters
+    ----------
+    path_format: string with format placeholders {z}, {x}, {y}, {ext}
+    ext: string
+        tile file extension (without '.')
+
+    Returns
+    -------
+    function of (z, x, y) returning the relative tile path
+    """
+
+    resolved = path_format.replace("{ext}", ext)
+    stripped = resolved.replace("{z}", "").replace("{x}", "").replace("{y}", "")
+    if "%" not in resolved and "{" not in stripped and "}" not in stripped:
+        fields = re.findall(r"\{([zxy])\}", resolved)
+        template = re.sub(r"\{[zxy]\}", "%d", resolved)
+
+        if fields == ["z", "x", "y"]:
+            return lambda z, x, y: template % (z, x, y)
+
+        index = {"z": 0, "x": 1, "y": 2}
+        positions = tuple(index[f] for f in fields)
+        return lambda z, x, y: template % tuple((z, x, y)[i] for i in positions)
+
+    return lambda z, x, y: path_format.format(z=z, x=x, y=y, ext=ext)
+
+
+def write_tile_file(filename, data):
+    """
+    Write tile bytes to filename via the raw file descriptor: tiles are
+    written whole, so Python's buffered IO layer is pure overhead here.
+
+    Parameters
+    ----------
+    filename: string
+        name of output tile file
+    data: bytes
+        tile data bytes
+    """
+
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        written = os.write(fd, data)
+        # short writes are rare for regular files but permitted by POSIX
+        while written < len(data):
+            written += os.write(fd, memoryview(data)[written:])
+    finally:
+        os.close(fd)
+
+
+def read_tile(bundle_data, offset):
     """
-    Read tile bytes at offset position in bundle.
+    Read tile bytes at offset position in bundle data.
 
     Parameters
     ----------
-    bundle: ArcGIS tile bundle file
+    bundle_data: bytes or memoryview
+        raw bytes of an ArcGIS tile bundle
     offset: offset in bytes to beginning of tile data block (first 4 bytes are length)
 
     Returns
@@ -106,12 +313,30 @@ def read_tile(bundle, offset):
     tile_bytes: bytes (may be empty)
     """
 
-    bundle.seek(offset)
-    return bundle.read(buffer_to_offset(bundle.read(4)))
+    # unpack_from reads straight out of the buffer without a slice allocation
+    length = _TILE_LENGTH.unpack_from(bundle_data, offset)[0]
+    return bytes(bundle_data[offset + 4 : offset + 4 + length])
 
 
 class TPK(object):
-    def __init__(self, filename):
+    # metadata fields persisted to the sidecar cache
+    METADATA_FIELDS = (
+        "root_name",
+        "format",
+        "tile_size",
+        "lods",
+        "zoom_levels",
+        "name",
+        "summary",
+        "tags",
+        "description",
+        "credits",
+        "use_constraints",
+        "bounds",
+        "legend",
+    )
+
+    def __init__(self, filename, cache_metadata=False):
         """
         Opens a tile package file for reading tiles and metadata.
 
@@ -119,20 +344,127 @@ class TPK(object):
         ----------
         filename: string
             name of tile package
+        cache_metadata: bool, default False
+            if True, parsed package metadata are cached to a sidecar
+            '<filename>.tpkmeta.json' file and reused on subsequent opens,
+            skipping the XML / JSON parsing.  The cache is ignored if older
+            than the tile package; failures to write it are ignored.
         """
         self._fp = ZipFile(filename)
 
+        # namelist() rebuilds its list from the zip directory on every call;
+        # large packages have tens of thousands of entries, so snapshot once
+        self._namelist = self._fp.namelist()
+
+        # Map the archive into memory: tile packages typically store bundles
+        # uncompressed, so their bytes can be served as zero-copy views over
+        # the mapping instead of fresh bytes objects per read.
+        try:
+            self._file = open(filename, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self._file = None
+            self._mmap = None
+
+        # bundle list is parsed from the archive on first read_tiles call
+        self._bundles = None
+
+        # decoded (index, offset) pairs per bundle, reused when read_tiles
+        # visits the same bundle again (e.g. metadata pass + export pass)
+        self._bundle_index_cache = {}
+
         # Fields specifically meant to be updated by user
         self.version = "1.0.0"
         self.attribution = ""
 
-        # Fields that may or may not be populated
-        self.legend = []
+        meta_cache_filename = "{0}.tpkmeta.json".format(filename)
+        if cache_metadata and self._load_cached_metadata(meta_cache_filename, filename):
+            return
+
+        self._parse_metadata()
+
+        if cache_metadata:
+            self._write_cached_metadata(meta_cache_filename)
+
+    def _load_cached_metadata(self, cache_filename, filename):
+        """
+        Load metadata fields from a sidecar cache file, if present and not
+        older than the tile package.
+
+        Returns
+        -------
+        bool: True if metadata were loaded from the cache
+        """
+
+        try:
+            if os.path.getmtime(cache_filename) < os.path.getmtime(filename):
+                return False
+
+            with open(cache_filename) as infile:
+                cached = json.load(infile)
+
+            for field in self.METADATA_FIELDS:
+                setattr(self, field, cached[field])
+
+            logger.debug("Read package metadata from cache")
+            return True
+
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def _write_cached_metadata(self, cache_filename):
+        """Write metadata fields to a sidecar cache file, ignoring failures."""
+
+        try:
+            with open(cache_filename, "w") as outfile:
+                json.dump(
+                    {field: getattr(self, field) for field in self.METADATA_FIELDS},
+                    outfile,
+                )
+        except OSError:
+            logger.debug("Could not write metadata cache: %s", cache_filename)
+
+    # fields parsed lazily on first access, and the file each comes from
+    _ITEMINFO_FIELDS = {
+        "name",
+        "summary",
+        "tags",
+        "description",
+        "credits",
+        "use_constraints",
+    }
+    _MAPSERVER_FIELDS = {"bounds", "legend"}
+
+    def __getattr__(self, item):
+        # only called for attributes not yet set: parse the descriptive
+        # metadata files on first use rather than at open
+        if item in self._ITEMINFO_FIELDS:
+            self._parse_iteminfo()
+        elif item in self._MAPSERVER_FIELDS:
+            self._parse_mapserver()
+        else:
+            raise AttributeError(item)
+
+        try:
+            return self.__dict__[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def _parse_metadata(self):
+        """Parse the tileset metadata (format, zoom levels) needed to read
+        tiles.  Descriptive metadata files are parsed lazily on first
+        attribute access."""
 
         logger.debug("Reading package metadata")
 
-        # File format, zoom levels, etc in .../<root layer name>/conf.xml
-        conf_filename = [f for f in self._fp.namelist() if "conf.xml" in f][0]
+        # File format, zoom levels, etc in .../<root layer name>/conf.xml.
+        # The root layer name varies by package, but "Layers" is by far the
+        # most common; try the O(1) lookup first and only scan the archive
+        # directory for unusual layouts.
+        try:
+            conf_filename = self._fp.getinfo("v101/Layers/conf.xml").filename
+        except KeyError:
+            conf_filename = next(f for f in self._namelist if f.endswith("/conf.xml"))
         self.root_name = os.path.split(os.path.dirname(conf_filename))[1]
         xml = ElementTree.fromstring(self._fp.read(conf_filename))
 
@@ -157,7 +489,9 @@ class TPK(object):
             zoom_level = calculate_zoom_from_resolution(resolution, self.tile_size)
             self.zoom_levels.append(zoom_level)
 
-        # Descriptive info in esriinfo/iteminfo.xml
+    def _parse_iteminfo(self):
+        """Parse descriptive metadata out of esriinfo/iteminfo.xml."""
+
         # Some fields are required by ArcGIS to create tile package
         xml = ElementTree.fromstring(self._fp.read("esriinfo/iteminfo.xml"))
         self.name = xml.find("title").text  # required field, provided automatically
@@ -171,6 +505,9 @@ class TPK(object):
         # optional, Use Constraints in ArcGIS
         self.use_constraints = xml.find("licenseinfo").text or ""
 
+    def _parse_mapserver(self):
+        """Parse bounds and legend out of the map server description."""
+
         # Bounding box, legend, etc is in .../servicedescriptions/mapserver/mapserver.json
         # NOTE: this may not accurately represent the outer bounds of available tiles
         sd = json.loads(
@@ -180,6 +517,7 @@ class TPK(object):
         )
         geoExtent = sd["resourceInfo"]["geoFullExtent"]
         self.bounds = [geoExtent[k] for k in ("xmin", "ymin", "xmax", "ymax")]
+        self.legend = []
 
         # convert to dict for easier access
         resources = {r["name"]: r for r in sd["resources"]}
@@ -214,6 +552,77 @@ class TPK(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+    def _member_bytes(self, name):
+        """
+        Read a zip member from the tile package.
+
+        Members stored without compression are returned as zero-copy
+        memoryviews over the memory-mapped archive; compressed members fall
+        back to a regular ZipFile read.
+
+        NOTE: this is the only place archive bytes are inflated.  Deflated
+        members are decompressed once, a whole bundle at a time (zlib
+        releases the GIL, so these reads parallelize in read_tiles); the
+        tile blobs themselves are raw PNG/JPG data and are never
+        re-inflated downstream.
+
+        Parameters
+        ----------
+        name: string
+            name of member within the tile package
+
+        Returns
+        -------
+        bytes or memoryview
+        """
+
+        if self._mmap is not None:
+            zinfo = self._fp.getinfo(name)
+            if zinfo.compress_type == ZIP_STORED:
+                offset = zinfo.header_offset
+                header = self._mmap[offset : offset + 30]
+                # filename / extra lengths in the local header can differ
+                # from the central directory, so read them from the header
+                if header[:4] == b"PK\x03\x04":
+                    name_len, extra_len = unpack("<HH", header[26:30])
+                    start = offset + 30 + name_len + extra_len
+                    return memoryview(self._mmap)[start : start + zinfo.file_size]
+
+        return self._fp.read(name)
+
+    def _decode_bundle(self, fname):
+        """
+        Read a bundle and its index from the tile package and decode the
+        occupied tile positions.
+
+        Runs on the read_tiles worker pool: the zip reads and the vectorized
+        index decode both release the GIL, so bundles decode in parallel
+        across cores.
+
+        Parameters
+        ----------
+        fname: string
+            name of .bundle file within the tile package
+
+        Returns
+        -------
+        (occupied, bundle_bytes) tuple, where occupied yields
+        (index, offset) pairs for tile positions that have data
+        """
+
+        bundle_data = self._member_bytes(fname)
+
+        occupied = self._bundle_index_cache.get(fname)
+        if occupied is None:
+            # discard 16 byte header
+            index_bytes = self._member_bytes(fname.replace(".bundle", ".bundlx"))[16:]
+            occupied = occupied_tile_offsets(
+                parse_bundle_index(index_bytes), bundle_data
+            )
+            self._bundle_index_cache[fname] = occupied
+
+        return occupied, bundle_data
+
     def read_tiles(self, zoom=None, flip_y=False):
         """
         Read all non-empty tiles from tile package, optionally limited to zoom
@@ -237,76 +646,122 @@ class TPK(object):
         if isinstance(zoom, int):
             zoom = [zoom]
 
-        bundles = []
-        for name in self._fp.namelist():
-            if "{0}/_alllayers/L".format(self.root_name) in name and ".bundle" in name:
-
-                # Only extract tiles for specified zoom levels
-                lod = int(name.split("/")[-2].lstrip("L"))
-                z = self.zoom_levels[lod]
-                if zoom is None or z in zoom:
-                    bundles.append(name)
-
-        for fname in bundles:
-            logger.info("Reading bundle: {0}".format(fname))
-            start = time.time()
-            # parse filename to determine row / col offset for bundle
-            # offsets are in hex
-            root = os.path.splitext(os.path.basename(fname))[0]
-            r_off, c_off = [int(x, 16) for x in root.lstrip("R").split("C")]
-
-            # LOD is derived from name of containing folder
-            lod = int(os.path.split(os.path.dirname(fname))[1].lstrip("L"))
-
-            # Resolve the ordinal level to zoom level
-            z = self.zoom_levels[lod]
+        # frozenset gives O(1) membership in the bundle filter below
+        zoom = None if zoom is None else frozenset(zoom)
+
+        if self._bundles is None:
+            bundle_prefix = "{0}/_alllayers/L".format(self.root_name)
+            parsed = []
+            for name in self._namelist:
+                if bundle_prefix in name and ".bundle" in name:
+                    lod = int(name.split("/")[-2].lstrip("L"))
+                    z = self.zoom_levels[lod]
+
+                    # row / col offset for the bundle is in its filename, in hex
+                    root = os.path.splitext(os.path.basename(name))[0]
+                    r_off, c_off = [int(x, 16) for x in root.lstrip("R").split("C")]
+                    parsed.append((z, r_off, c_off, name))
+
+            # keep bundles in (zoom, row, column) order so successive reads
+            # from the archive are as sequential as possible
+            parsed.sort()
+            self._bundles = parsed
+
+        # Only extract tiles for specified zoom levels
+        bundles = [b for b in self._bundles if zoom is None or b[0] in zoom]
+
+        # Read bundle and index bytes in a thread pool: the zip member reads
+        # (and inflation, for compressed archives) release the GIL, so
+        # several bundles are fetched while the main thread parses tiles.
+        # Prefetch depth is bounded to avoid loading the whole archive.
+        max_workers = min(len(bundles), os.cpu_count() or 1) or 1
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            bundle_iter = iter(bundles)
+            pending = deque(
+                (bundle, executor.submit(self._decode_bundle, bundle[-1]))
+                for bundle in islice(bundle_iter, max_workers * 2)
+            )
 
-            # max row and column value allowed at this WTMS zoom level:  (2**zoom_level) - 1
-            max_row_col = (1 << z) - 1
+            while pending:
+                (z, r_off, c_off, fname), future = pending.popleft()
+                occupied, bundle_data = future.result()
 
-            # discard 16 byte header
-            index_bytes = self._fp.read(fname.replace(".bundle", ".bundlx"))[16:]
-
-            bundle_bytes = BytesIO(self._fp.read(fname))
-            index = 0
-            max_index = BUNDLE_DIM ** 2
-            while index < max_index:
-                data = read_tile(
-                    bundle_bytes,
-                    buffer_to_offset(
-                        index_bytes[index * INDEX_SIZE : (index + 1) * INDEX_SIZE]
-                    ),
-                )
-                if data:
-                    # x = column (longitude), y = row (latitude)
-                    col = int(math.floor(float(index) / BUNDLE_DIM))
-                    x = c_off + col
-                    y = r_off + (index % BUNDLE_DIM)
-
-                    # ensure resultant row and column values fall within range!
-                    if (0 <= x <= max_row_col) and (0 <= y <= max_row_col):
-                        if flip_y:
-                            y = max_row_col - y
-
-                        yield Tile(z, x, y, data)
-                    else:
-                        logger.debug(
-                            "Tile out of range, zoom level = {0}, column = {1}, row = {2}".format(
-                                z, x, y
-                            )
+                next_bundle = next(bundle_iter, None)
+                if next_bundle is not None:
+                    pending.append(
+                        (
+                            next_bundle,
+                            executor.submit(self._decode_bundle, next_bundle[-1]),
                         )
-                        discarded_tiles += 1
+                    )
+
+                logger.info("Reading bundle: %s", fname)
+                # only pay for the timing call when debug logging is on
+                timing = logger.isEnabledFor(logging.DEBUG)
+                if timing:
+                    start = time.time()
+
+                # max row and column value allowed at this WTMS zoom level:  (2**zoom_level) - 1
+                max_row_col = (1 << z) - 1
+
+                # fold the y-flip into a per-bundle XOR mask, so the inner
+                # loop needs no flip branch per tile.  For in-range rows
+                # y ^ mask == mask - y, the xyz flip; out-of-range rows have
+                # a bit above the mask, so they stay out of range.
+                flip_mask = max_row_col if flip_y else 0
+
+                # almost all bundles lie entirely within the zoom level's
+                # row / column range; decide once per bundle so the common
+                # case skips the per-tile range check
+                fully_in_range = (
+                    c_off + BUNDLE_DIM - 1 <= max_row_col
+                    and r_off + BUNDLE_DIM - 1 <= max_row_col
+                )
 
-                index += 1
-            logger.debug("Time to read bundle: {0:2f}".format(time.time() - start))
+                if fully_in_range:
+                    for index, offset in occupied:
+                        data = read_tile(bundle_data, offset)
+                        if data:
+                            # x = column (longitude), y = row (latitude)
+                            col, row = divmod(index, BUNDLE_DIM)
+                            yield Tile(z, c_off + col, (r_off + row) ^ flip_mask, data)
+                else:
+                    for index, offset in occupied:
+                        data = read_tile(bundle_data, offset)
+                        if data:
+                            col, row = divmod(index, BUNDLE_DIM)
+                            x = c_off + col
+                            y = (r_off + row) ^ flip_mask
+
+                            # ensure resultant row and column values fall within range!
+                            # (the flip maps the valid range onto itself, so the
+                            # check holds in either scheme)
+                            if (0 <= x <= max_row_col) and (0 <= y <= max_row_col):
+                                yield Tile(z, x, y, data)
+                            else:
+                                logger.debug(
+                                    "Tile out of range, zoom level = %d, "
+                                    "column = %d, row = %d",
+                                    z,
+                                    x,
+                                    y,
+                                )
+                                discarded_tiles += 1
+
+                if timing:
+                    logger.debug("Time to read bundle: %f", time.time() - start)
+
+        finally:
+            executor.shutdown()
 
         logger.info(
-            'Total number of discarded "out of range" tiles = {0}'.format(
-                discarded_tiles
-            )
+            'Total number of discarded "out of range" tiles = %d', discarded_tiles
         )
 
-    def to_mbtiles(self, filename, zoom=None, tile_bounds=False, drop_empty=False):
+    def to_mbtiles(
+        self, filename, zoom=None, tile_bounds=False, drop_empty=False, append=False
+    ):
         """
         Export tile package to mbtiles v1.1 file, optionally limited to zoom
         levels.  If filename exists, it will be overwritten.  If filename
@@ -322,6 +777,12 @@ class TPK(object):
             if True, will use the tile bounds of the highest zoom level exported to determine tileset bounds
         drop_empty: bool, default False
             if True, tiles that are empty will not be output
+        append: bool, default False
+            if True, filename must be an existing mbtiles file; tiles are
+            added to it and any tiles already present at a given
+            (z, x, y) are kept, which is much faster than replacing them.
+            The zoom range in the metadata is widened to cover both the
+            existing and the new tiles.
         """
 
         if self.format.lower() == "mixed":
@@ -332,7 +793,10 @@ class TPK(object):
         if not filename.endswith(".mbtiles"):
             filename = "{0}.mbtiles".format(filename)
 
-        with MBtiles(filename, "w") as mbtiles:
+        if append and not os.path.exists(filename):
+            raise IOError("mbtiles file to append to not found: {0}".format(filename))
+
+        with MBtiles(filename, "r+" if append else "w") as mbtiles:
             if zoom is None:
                 zoom = self.zoom_levels
             elif isinstance(zoom, int):
@@ -342,17 +806,52 @@ class TPK(object):
             # Zooms for which at least some tiles have not been dropped
             real_zooms = set()
 
-            def tile_generator():
+            # Pipeline: the sqlite writer runs on a background thread fed
+            # from a bounded queue, so tile reading / decoding overlaps with
+            # the database inserts instead of alternating with them.  Tiles
+            # travel through the queue in insert-sized batches to keep the
+            # queue locking overhead off the per-tile path; a depth of 2 is
+            # enough to overlap read and write while capping buffered tiles
+            # at a few batches.
+            queue = Queue(maxsize=2)
+            sentinel = object()
+            writer = ThreadPoolExecutor(max_workers=1)
+            future = writer.submit(
+                mbtiles.add_tiles,
+                chain.from_iterable(iter(queue.get, sentinel)),
+                replace=not append,
+            )
+
+            def put(item):
+                # bounded put, re-checking that the writer is still alive
+                # so an insert error cannot deadlock the feeder
+                while not future.done():
+                    try:
+                        queue.put(item, timeout=1)
+                        return True
+                    except Full:
+                        continue
+                return False
+
+            batch = []
+            try:
                 for tile in self.read_tiles(zoom, flip_y=True):
-                    if (
-                        drop_empty
-                        and hashlib.sha1(tile.data).hexdigest() in EMPTY_TILES
-                    ):
+                    if drop_empty and is_empty_tile(tile.data):
                         continue
                     real_zooms.add(tile.z)
-                    yield tile
 
-            mbtiles.write_tiles(tile_generator())
+                    batch.append(tile)
+                    if len(batch) >= BATCH_SIZE:
+                        if not put(batch):
+                            break
+                        batch = []
+            finally:
+                if batch:
+                    put(batch)
+                put(sentinel)
+                writer.shutdown()
+            # re-raise any writer error
+            future.result()
 
             zoom = sorted(real_zooms)
 
@@ -382,6 +881,14 @@ class TPK(object):
                 (zoom[0] + zoom[-1]) // 2,
             )
 
+            minzoom, maxzoom = zoom[0], zoom[-1]
+            if append:
+                # widen the zoom range to cover the existing tileset
+                if "minzoom" in mbtiles.meta:
+                    minzoom = min(minzoom, int(mbtiles.meta["minzoom"]))
+                if "maxzoom" in mbtiles.meta:
+                    maxzoom = max(maxzoom, int(mbtiles.meta["maxzoom"]))
+
             mbtiles.meta.update(
                 {
                     "name": self.name,
@@ -395,8 +902,8 @@ class TPK(object):
                     "format": self.format.lower().replace("jpeg", "jpg")[:3],
                     "bounds": ",".join("{0:4f}".format(v) for v in bounds),
                     "center": center,
-                    "minzoom": zoom[0],
-                    "maxzoom": zoom[-1],
+                    "minzoom": minzoom,
+                    "maxzoom": maxzoom,
                     "legend": json.dumps(self.legend) if self.legend else "",
                 }
             )
@@ -450,17 +957,53 @@ class TPK(object):
         zoom = list(zoom)
         zoom.sort()
 
-        for tile in self.read_tiles(zoom, flip_y=(scheme == "xyz")):
-            if drop_empty and hashlib.sha1(tile.data).hexdigest() in EMPTY_TILES:
-                continue
+        # cache directories already created (keyed by their path relative to
+        # the output root) to avoid a stat per tile; the empty key is the
+        # output root itself, which already exists and also covers path
+        # formats with no directory component
+        created_dirs = {""}
+        prefix = path if path.endswith(os.sep) else path + os.sep
+
+        # Tile writes go to a small worker pool so file IO overlaps with
+        # reading and decoding the next tiles.  The pending queue is bounded
+        # to apply backpressure rather than buffering every tile in memory.
+        writer_pool = ThreadPoolExecutor(max_workers=4)
+        pending = deque()
+        format_tile_path = compile_path_format(path_format, ext)
+        try:
+            for tile in self.read_tiles(zoom, flip_y=(scheme == "xyz")):
+                if drop_empty and is_empty_tile(tile.data):
+                    continue
+
+                filename = format_tile_path(tile.z, tile.x, tile.y)
+                dirname = filename.rpartition("/")[0]
+                if dirname not in created_dirs:
+                    os.makedirs(prefix + dirname, exist_ok=True)
+                    created_dirs.add(dirname)
+
+                pending.append(
+                    writer_pool.submit(write_tile_file, prefix + filename, tile.data)
+                )
+                if len(pending) >= 256:
+                    pending.popleft().result()
 
-            filename = path_format.format(z=tile.z, x=tile.x, y=tile.y, ext=ext)
-            out_path = os.path.join(path, os.path.split(filename)[0])
-            if not os.path.exists(out_path):
-                os.makedirs(out_path)
+            while pending:
+                pending.popleft().result()
 
-            with open(os.path.join(path, filename), "wb") as outfile:
-                outfile.write(tile.data)
+        finally:
+            writer_pool.shutdown()
 
     def close(self):
         self._fp.close()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a live read_tiles generator still holds memoryviews over
+                # the mapping; drop our reference and let it be released
+                # once those views are garbage collected
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
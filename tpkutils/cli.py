@@ -11,6 +11,22 @@ from tpkutils import TPK
 logger = logging.getLogger("tpkutils")
 
 
+def parse_zoom(zoom):
+    """Parse a CLI zoom option like "0,1,2" into a sorted list of unique
+    zoom levels, or None if not provided.  Parsed once here so downstream
+    export loops never touch the raw string."""
+
+    if zoom is None:
+        return None
+
+    try:
+        return sorted({int(v) for v in zoom.split(",")})
+    except ValueError:
+        raise click.BadParameter(
+            'zoom must be a comma-delimited list of integers, e.g. "0,1,2"'
+        )
+
+
 def configure_logging(verbose):
     if verbose == 2:
         level = logging.DEBUG
@@ -79,8 +95,7 @@ def mbtiles(
 
     start = time.time()
 
-    if zoom is not None:
-        zoom = [int(v) for v in zoom.split(",")]
+    zoom = parse_zoom(zoom)
 
     tpk = TPK(tpk_filename)
     tpk.to_mbtiles(
@@ -148,8 +163,7 @@ def disk(tpk_filename, path, zoom, scheme, drop_empty, path_format, preview, ver
 
     start = time.time()
 
-    if zoom is not None:
-        zoom = [int(v) for v in zoom.split(",")]
+    zoom = parse_zoom(zoom)
 
     with TPK(tpk_filename) as tpk:
         tpk.to_disk(path, zoom, scheme, drop_empty, path_format)
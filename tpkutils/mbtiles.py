@@ -0,0 +1,431 @@
+"""
+MBtiles writer optimized for bulk loading of tiles from a tile package.
+
+Tiles are written in batched transactions via executemany rather than a
+commit per tile, which avoids an fsync for every insert.  Tile blobs are
+deduplicated by content hash, so repeated tiles (e.g. blank ocean tiles)
+are stored once.
+"""
+
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from itertools import chain, islice
+
+from pymbtiles import Tile
+
+logger = logging.getLogger("tpkutils")
+
+
+BATCH_SIZE = 10000  # number of tiles inserted per executemany batch
+
+# hash cache misses on the worker pool only when a batch has at least this
+# many of them; smaller batches are not worth the dispatch overhead
+PARALLEL_HASH_THRESHOLD = 256
+
+# read once at import instead of per connection
+with open(os.path.join(os.path.dirname(__file__), "mbtiles_schema.sql")) as f:
+    _SCHEMA = f.read()
+
+
+def _tile_id(data):
+    """Content hash used to key unique tile blobs."""
+
+    return blake2b(data, digest_size=16).digest()
+
+
+def _tile_ids(payloads):
+    """Hash a list of tile payloads; runs as one task on the hash pool."""
+
+    return [_tile_id(data) for data in payloads]
+
+
+class MBtiles(object):
+    """
+    Interface for creating and reading mbtiles v1.1 files.
+
+    meta attribute maps to the metadata table in the mbtiles file.
+    """
+
+    class Metadata(dict):
+        def __init__(self, db, cursor, autoload=True):
+            self._db = db
+            self._cursor = cursor
+            if autoload:
+                self._cursor.execute("SELECT name, value from metadata")
+                dict.update(self, {row[0]: row[1] for row in self._cursor.fetchall()})
+
+        def __setitem__(self, k, v):
+            dict.__setitem__(self, k, v)
+            # connection is in autocommit (isolation_level=None)
+            self._cursor.execute(
+                "INSERT OR REPLACE INTO metadata (name, value) values (?, ?)", (k, v)
+            )
+
+        def update(self, *args, **kwargs):
+            dict.update(self, *args, **kwargs)
+            self._cursor.execute("BEGIN")
+            self._cursor.executemany(
+                "INSERT OR REPLACE INTO metadata (name, value) values (?, ?)",
+                self.items(),
+            )
+            self._cursor.execute("COMMIT")
+
+    def __init__(self, filename, mode="r"):
+        """
+        Creates an open mbtiles file.  Must be closed after all data are added.
+
+        Parameters
+        ----------
+        filename: string
+            name of mbtiles file
+        mode: string, one of ('r', 'w', 'r+')
+            if 'w', existing mbtiles file will be deleted first
+        """
+
+        self.mode = mode
+        if mode not in ("r", "w", "r+"):
+            raise ValueError("Mode must be r, w, or r+")
+
+        if os.path.exists(filename):
+            if mode == "w":
+                os.remove(filename)
+        elif "r" in mode:
+            raise IOError("mbtiles not found: {0}".format(filename))
+
+        connect_mode = "ro" if mode == "r" else "rwc"
+        # check_same_thread is disabled so bulk writes can run on a single
+        # background writer thread; the connection is still only ever used
+        # from one thread at a time
+        self._db = sqlite3.connect(
+            "file:{0}?mode={1}".format(filename, connect_mode),
+            uri=True,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._cursor = self._db.cursor()
+
+        # tuning that is safe for every mode: a large page cache,
+        # in-memory temp tables and memory-mapped reads
+        for pragma in (
+            "PRAGMA cache_size=-65536",
+            "PRAGMA temp_store=MEMORY",
+            "PRAGMA mmap_size=268435456",
+            "PRAGMA busy_timeout=5000",
+        ):
+            self._cursor.execute(pragma)
+
+        if mode == "w":
+            # Bulk-load tuning: journaling and fsyncs are of no value for a
+            # write-once export (on failure the file is recreated anyway).
+            # 8 KB pages keep typical 5-50 KB tile blobs off long overflow
+            # chains without the read amplification of larger pages;
+            # page_size must be set before the schema is created.
+            for pragma in (
+                "PRAGMA journal_mode=OFF",
+                "PRAGMA synchronous=OFF",
+                "PRAGMA locking_mode=EXCLUSIVE",
+                "PRAGMA page_size=8192",
+            ):
+                self._cursor.execute(pragma)
+
+        elif mode == "r+":
+            # appending must never corrupt an existing file, so keep a
+            # journal: WAL with synchronous=NORMAL fsyncs only at
+            # checkpoints instead of at every commit
+            self._cursor.execute("PRAGMA journal_mode=WAL")
+            self._cursor.execute("PRAGMA synchronous=NORMAL")
+
+        if mode != "r":
+            self._cursor.executescript(_SCHEMA)
+
+        self._meta = self.Metadata(self._db, self._cursor)
+
+        # tile ids already written, so duplicate blobs are only inserted once
+        self._seen_ids = set()
+
+        # payload -> id cache so runs of identical tiles (blank ocean /
+        # transparent tiles) skip re-hashing; keyed by a cheap prefix probe
+        # and verified against the full payload before reuse
+        self._tile_id_cache = {}
+
+        # created on first large batch; hashlib releases the GIL for
+        # payloads over ~2 KB, so hashing fans out across cores while all
+        # database writes stay on the calling thread
+        self._hash_pool = None
+        self._hash_workers = os.cpu_count() or 1
+        self._has_tile_index = mode == "r"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def meta(self):
+        return self._meta
+
+    @meta.setter
+    def meta(self, value):
+        self._meta = self.Metadata(self._db, self._cursor, autoload=False)
+        self._meta.update(value)
+
+    def _ensure_tile_index(self):
+        """
+        Create the unique index on images if not already present.
+
+        Index creation is deferred until after bulk load, but queries against
+        the tiles view (e.g. the row / column ranges used to compute tile
+        bounds) need the index to avoid full scans, so it is built on first
+        use.  map needs no separate index: it is a WITHOUT ROWID table
+        clustered on (zoom_level, tile_column, tile_row).
+        """
+
+        if self._has_tile_index:
+            return
+
+        self._cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)"
+        )
+        self._has_tile_index = True
+
+    def zoom_range(self):
+        """Return the minimum and maximum zoom levels available in the tileset."""
+
+        self._ensure_tile_index()
+        return tuple(
+            self._cursor.execute(
+                "select min(zoom_level), max(zoom_level) from tiles"
+            ).fetchone()
+        )
+
+    def row_range(self, z=0):
+        """Return the minimum and maximum row available for a given zoom level.
+
+        NOTE: this will return (None, None) for a zoom level not present in
+        the tileset.
+
+        Parameters
+        ----------
+        z : int, optional (default: 0)
+            zoom level to query for available rows
+        """
+
+        self._ensure_tile_index()
+        return tuple(
+            self._cursor.execute(
+                "select min(tile_row), max(tile_row) from tiles where zoom_level = ?",
+                (z,),
+            ).fetchone()
+        )
+
+    def col_range(self, z=0):
+        """Return the minimum and maximum column available for a given zoom level.
+
+        NOTE: this will return (None, None) for a zoom level not present in
+        the tileset.
+
+        Parameters
+        ----------
+        z : int, optional (default: 0)
+            zoom level to query for available columns
+        """
+
+        self._ensure_tile_index()
+        return tuple(
+            self._cursor.execute(
+                "select min(tile_column), max(tile_column) from tiles where zoom_level = ?",
+                (z,),
+            ).fetchone()
+        )
+
+    def read_tile(self, z, x, y):
+        """
+        Get the tile data for z, x, y values.
+
+        Parameters
+        ----------
+        z: int
+            zoom level
+        x: int
+            tile column
+        y: int
+            tile row
+
+        Returns
+        -------
+        tile data in bytes.  None if no tile exists.
+        """
+
+        self._ensure_tile_index()
+        self._cursor.execute(
+            "SELECT tile_data FROM tiles "
+            "where zoom_level=? and tile_column=? and tile_row=? LIMIT 1",
+            (z, x, y),
+        )
+
+        row = self._cursor.fetchone()
+        if row is None:
+            return None
+
+        return row[0]
+
+    def add_tile(self, z, x, y, data):
+        """
+        Add a single tile to the mbtiles file.  Note: this is a thin wrapper
+        over add_tiles, which is much more efficient for inserting several
+        tiles at once.
+
+        Parameters
+        ----------
+        z: int
+            zoom level
+        x: int
+            tile column
+        y: int
+            tile row
+        data: bytes
+            tile data bytes
+        """
+
+        self.add_tiles([Tile(z, x, y, data)])
+
+    def add_tiles(self, tiles, replace=True):
+        """
+        Add tiles to the mbtiles file in batched transactions.
+
+        Tiles are consumed from the iterable in batches of BATCH_SIZE and
+        inserted with a single executemany per batch, so at most one commit
+        occurs per batch rather than one per tile.
+
+        Parameters
+        ----------
+        tiles: iterable of (z, x, y, data) tuples (Tile namedtuples or
+            plain tuples)
+        replace: bool, default True
+            if False, tiles already present at a given (z, x, y) are kept;
+            skipping them is faster than replacing when appending to an
+            existing tileset.
+        """
+
+        if self.mode == "w":
+            # fresh file: _seen_ids fully dedups ids within the session and
+            # no unique index exists yet, so a plain INSERT suffices
+            images_statement = "INSERT INTO images (tile_id, tile_data) values (?, ?)"
+        else:
+            # appending to an existing file, whose unique tile_id index is
+            # present: target it explicitly so only uniqueness conflicts are
+            # suppressed rather than all constraint errors
+            images_statement = (
+                "INSERT INTO images (tile_id, tile_data) values (?, ?) "
+                "ON CONFLICT (tile_id) DO NOTHING"
+            )
+
+        map_statement = (
+            "INSERT OR {0} INTO map "
+            "(zoom_level, tile_column, tile_row, tile_id) "
+            "values (?, ?, ?, ?)".format("REPLACE" if replace else "IGNORE")
+        )
+
+        tiles = iter(tiles)
+        while True:
+            batch = list(islice(tiles, BATCH_SIZE))
+            if not batch:
+                break
+
+            images = []
+            id_cache = self._tile_id_cache
+
+            # resolve repeats through the payload cache first; only cache
+            # misses need hashing.  tuple unpacking is faster than per-row
+            # attribute lookups and also accepts plain tuples
+            ids = [None] * len(batch)
+            misses = []
+            for i, (z, x, y, data) in enumerate(batch):
+                probe = (len(data), bytes(data[:64]))
+                cached = id_cache.get(probe)
+                if cached is not None and cached[0] == data:
+                    ids[i] = cached[1]
+                else:
+                    misses.append((i, probe, cached is None))
+
+            if misses:
+                payloads = [batch[i][3] for i, _, _ in misses]
+                if len(payloads) >= PARALLEL_HASH_THRESHOLD:
+                    if self._hash_pool is None:
+                        self._hash_pool = ThreadPoolExecutor(
+                            max_workers=self._hash_workers
+                        )
+                    # one slice per worker, so pool overhead is per slice
+                    # rather than per tile
+                    step = -(-len(payloads) // self._hash_workers)
+                    digests = chain.from_iterable(
+                        future.result()
+                        for future in [
+                            self._hash_pool.submit(_tile_ids, payloads[i : i + step])
+                            for i in range(0, len(payloads), step)
+                        ]
+                    )
+                else:
+                    digests = map(_tile_id, payloads)
+
+                for (i, probe, cacheable), id in zip(misses, digests):
+                    ids[i] = id
+                    data = batch[i][3]
+                    if cacheable and len(id_cache) < 1000:
+                        id_cache[probe] = (data, id)
+                    if id not in self._seen_ids:
+                        self._seen_ids.add(id)
+                        # bytes bind directly as BLOB; no sqlite3.Binary
+                        # wrapper object needed per tile
+                        images.append((id, data))
+
+            tile_map = [(tile[0], tile[1], tile[2], id) for tile, id in zip(batch, ids)]
+
+            self._cursor.execute("BEGIN")
+            try:
+                self._cursor.executemany(images_statement, images)
+                self._cursor.executemany(map_statement, tile_map)
+                self._cursor.execute("COMMIT")
+
+            except sqlite3.Error:
+                logger.exception("Error inserting tiles, rolling back database")
+                self._cursor.execute("ROLLBACK")
+                raise
+
+    # API compatibility with pymbtiles.MBtiles
+    write_tile = add_tile
+    write_tiles = add_tiles
+
+    def close(self, vacuum=False):
+        """
+        Close the mbtiles file.  If it was opened for writing, the tile
+        indexes are created here (much faster than maintaining them during
+        bulk load).
+
+        Parameters
+        ----------
+        vacuum: bool, default False
+            if True, compact the file before closing.  VACUUM rewrites the
+            whole database, which can dominate build time; freshly built
+            files have little free space, so it is off by default.
+        """
+
+        if self.mode != "r":
+            self._ensure_tile_index()
+            if self.mode == "r+":
+                # WAL is persistent in the file header; checkpoint and
+                # restore the default journal so read-only consumers are
+                # not required to support WAL
+                self._cursor.execute("PRAGMA journal_mode=DELETE")
+            if vacuum:
+                # VACUUM must run outside any open transaction
+                self._cursor.execute("VACUUM")
+            self._cursor.execute("PRAGMA optimize")
+            if self._hash_pool is not None:
+                self._hash_pool.shutdown()
+        self._cursor.close()
+        self._db.close()
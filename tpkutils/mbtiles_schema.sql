@@ -0,0 +1,44 @@
+-- Derived from https://github.com/mapbox/node-mbtiles/blob/master/lib/schema.sql
+--
+-- mbtiles v1.1 schema for tiles and metadata.  Tile data are stored
+-- normalized: unique tile blobs live in `images`, keyed by a content hash,
+-- and `map` points each (zoom_level, tile_column, tile_row) at its blob.
+-- The spec-required `tiles` table is exposed as a view over the join.
+
+BEGIN;
+
+-- map is clustered on its natural key: a single B-tree serves as both the
+-- table and the (zoom_level, tile_column, tile_row) index, so no separate
+-- index is needed and each insert writes fewer pages.
+CREATE TABLE IF NOT EXISTS map (
+   zoom_level INTEGER NOT NULL,
+   tile_column INTEGER NOT NULL,
+   tile_row INTEGER NOT NULL,
+   tile_id BLOB,
+   PRIMARY KEY (zoom_level, tile_column, tile_row)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS images (
+    tile_data BLOB,
+    tile_id BLOB
+);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    name TEXT,
+    value TEXT
+);
+
+-- NOTE: the unique index on images is created on close, after bulk
+-- loading, which is substantially faster than maintaining it per insert.
+CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name);
+
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT
+        map.zoom_level AS zoom_level,
+        map.tile_column AS tile_column,
+        map.tile_row AS tile_row,
+        images.tile_data AS tile_data
+    FROM map
+    JOIN images ON images.tile_id = map.tile_id;
+
+COMMIT;